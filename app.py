@@ -29,7 +29,6 @@ class App(Flask):
         self.frame_dict = self.mongo_api.load_frame_cache(self.mongo_api.FRAMES)
         self.postgres_api = PostgresAPI(database="semantic_kb")
         self.message_engine = MessageEngine(self.postgres_api, self.frame_dict)
-        self.cache = []
         self.status = 0
         self.populate_content_progress = (100, 0)
         self.populate_frames_progress = (100, 0)
@@ -1,5 +1,7 @@
 # Insert passed headings and sentences into KB
 from datetime import datetime
+from queue import Queue
+from threading import Thread
 
 from app import App
 from core.api import PostgresAPI
@@ -7,29 +9,59 @@ from core.engine import doc_engine
 from core.parsers import TextParser
 
 SMOOTHING_FACTOR = 0.05
+BATCH_SIZE = 500
+QUEUE_SIZE = 100
+# Queued instead of None when parsing fails, so that partially parsed content is not committed
+ABORT = object()
 SPLIT_CHAR = '__'
 POSTGRES_API = PostgresAPI(maintenance=True)
 
 
-def __process_content(app: App, headings: list, sentences: list):
-    def __process_sentences(sents: list, h_id: int):
-        # sentence parsing logic
-        for sentence in sents:
-            for pos_tags in TextParser.generate_pos_tag_sets(sentence):
-                entities = TextParser.extract_entities(pos_tags)
-                sentence = ' '.join(('%s%s%s' % (token, SPLIT_CHAR, pos) for token, pos in pos_tags))
-                # add result to cache
-                app.cache += [(sentence, entities, [], h_id)]
+def __process_content(sentences: list) -> list:
+    # sentence parsing logic. Returns the parametrized sentences as (sentence, entities, dependencies)
+    parsed_sentences = []
+    for sentence in sentences:
+        for pos_tags in TextParser.generate_pos_tag_sets(sentence):
+            entities = TextParser.extract_entities(pos_tags)
+            sentence = ' '.join(('%s%s%s' % (token, SPLIT_CHAR, pos) for token, pos in pos_tags))
+            parsed_sentences += [(sentence, entities, [])]
+    return parsed_sentences
 
-    # insert all headings and get the immediate heading id
-    heading_id = POSTGRES_API.insert_headings(headings)
-    # insert the sentences using that heading id
-    __process_sentences(sentences, heading_id)
-    # persist cache in database
-    if len(app.cache) > 0:
-        for s, n, d, h in app.cache:
-            POSTGRES_API.insert_sentence(s, n, d, h)
-        app.cache.clear()
+
+def __insert_content(content_queue: Queue, errors: list):
+    # insert (headings, parsed sentences) from the queue into KB until None (or ABORT) is received,
+    # committing every BATCH_SIZE sentences to keep each transaction bounded
+    pending = 0
+    inserted = 0
+    try:
+        POSTGRES_API.begin_bulk_load()
+        for item in iter(content_queue.get, None):
+            # if the producer failed, discard the open batch instead of finalizing partial content
+            if item is ABORT:
+                POSTGRES_API.rollback_batch()
+                return
+            headings, parsed_sentences = item
+            # insert all headings and get the immediate heading id
+            heading_id = POSTGRES_API.insert_headings(headings)
+            # insert the sentences using that heading id
+            for s, n, d in parsed_sentences:
+                POSTGRES_API.insert_sentence(s, n, d, heading_id)
+            pending += len(parsed_sentences)
+            if pending >= BATCH_SIZE:
+                POSTGRES_API.commit_batch()
+                POSTGRES_API.begin_bulk_load()
+                inserted += pending
+                pending = 0
+                print('%d sentences inserted' % inserted)
+        # Refresh the table statistics, and commit changes to KB
+        POSTGRES_API.analyze_tables()
+        POSTGRES_API.commit_batch()
+    except Exception as ex:
+        errors += [ex]
+        POSTGRES_API.rollback_batch()
+        # keep consuming, so that the producer is not blocked on a full queue
+        while content_queue.get() not in (None, ABORT):
+            pass
 
 
 def __calculate_progress(current: int, total: int, start_time: datetime, p_timestamp: datetime):
@@ -57,18 +89,33 @@ def populate_content(app: App) -> next:
     i = 0
     POSTGRES_API.initialize_db()
     count = app.mongo_api.get_document_count(app.mongo_api.SCRAPED_DOCS)
+    # parse content in this thread, while a background thread inserts parsed content into KB
+    content_queue = Queue(maxsize=QUEUE_SIZE)
+    errors = []
+    consumer = Thread(target=__insert_content, args=(content_queue, errors))
+    consumer.start()
 
-    for heading_list, flattened_sentences in doc_engine.get_doc_content(app.mongo_api):
-        # catch end of document
-        if heading_list is None and flattened_sentences is None:
-            timestamp, percent, est_time = __calculate_progress(i + 1, count, start_time, timestamp)
-            app.populate_content_progress = (percent, est_time)
-            i += 1
-        # insert content
-        else:
-            __process_content(app, heading_list, flattened_sentences)
-    # Commit changes to KB
-    POSTGRES_API.conn.commit()
+    completed = False
+    try:
+        for heading_list, flattened_sentences in doc_engine.get_doc_content(app.mongo_api):
+            # stop parsing as soon as the consumer fails
+            if len(errors) > 0:
+                break
+            # catch end of document
+            if heading_list is None and flattened_sentences is None:
+                timestamp, percent, est_time = __calculate_progress(i + 1, count, start_time, timestamp)
+                app.populate_content_progress = (percent, est_time)
+                i += 1
+            # queue content for insertion
+            else:
+                content_queue.put((heading_list, __process_content(flattened_sentences)))
+        completed = True
+    finally:
+        # Wait until all queued content is inserted (or discarded, if parsing failed)
+        content_queue.put(None if completed else ABORT)
+        consumer.join()
+    if len(errors) > 0:
+        raise errors[0]
     completion_time = datetime.now()
     app.populate_content_progress = (100, 0)
     print('Done! (time taken: %s seconds)' % (completion_time - start_time).seconds)
@@ -80,13 +127,24 @@ def populate_frames(app: App):
     timestamp = start_time
     count = POSTGRES_API.get_sentence_count()
     app.frame_dict = app.mongo_api.load_frame_cache(app.mongo_api.FRAMES)
-    for i, (sentence_id, sentence_pos) in enumerate(POSTGRES_API.get_all_sentences()):
-        sent_frames = TextParser.get_frames(sentence_pos, app.frame_dict)
-        POSTGRES_API.insert_frames(sentence_id, sent_frames)
-        timestamp, percent, est_time = __calculate_progress(i + 1, count, start_time, timestamp)
-        app.populate_frames_progress = (percent, est_time)
+    POSTGRES_API.begin_bulk_load()
+    try:
+        for i, (sentence_id, sentence_pos) in enumerate(POSTGRES_API.get_all_sentences()):
+            sent_frames = TextParser.get_frames(sentence_pos, app.frame_dict)
+            POSTGRES_API.insert_frames(sentence_id, sent_frames)
+            # commit every BATCH_SIZE sentences, to keep each transaction bounded
+            if (i + 1) % BATCH_SIZE == 0:
+                POSTGRES_API.commit_batch()
+                POSTGRES_API.begin_bulk_load()
+            # count is an estimate, so never let progress exceed 100%
+            timestamp, percent, est_time = __calculate_progress(i + 1, max(count, i + 1), start_time, timestamp)
+            app.populate_frames_progress = (percent, est_time)
+    except Exception:
+        # discard the open batch, and release its connection back to the pool
+        POSTGRES_API.rollback_batch()
+        raise
     # commit changes to KB
-    POSTGRES_API.conn.commit()
+    POSTGRES_API.commit_batch()
     completion_time = datetime.now()
     app.populate_frames_progress = (100, 0)
     print('Done! (time taken: %s seconds)' % (completion_time - start_time).seconds)
@@ -1,38 +1,92 @@
-import pg8000 as psql
-
+import re
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import count
+from queue import Queue
+from threading import local
+
+import psycopg
+
+POOL_SIZE = 4
+POOL_TIMEOUT = 60
+QUERY_CACHE_SIZE = 1024
 ERROR_TOLERANCE = 5
+# Minimum trigram similarity for an entity to be considered for a levenshtein match (pg_trgm defaults to 0.3, which
+# drops short or punctuated near-matches, e.g. 'ei' vs 'e-i' has similarity ~0.17 but edit distance 1)
+SIMILARITY_THRESHOLD = 0.1
 MAX_ENTITY_LENGTH = 50
 ROOT_NODE_NAME = 'ROOT'
 SPLIT_CHAR = '__'
 MIN_RESULT_COUNT = 3
+RE_TAGGED_TOKEN = re.compile(r'(\S+)%s(\S*)' % re.escape(SPLIT_CHAR))
 
 
-def str_conv(iterable: list, start: str = '{', end: str = '}') -> str:
-    result = "%s%s%s" % (start, '' if len(iterable) == 0 else str(iterable)[1:-1], end)
-    return result
+def split_tags(sentence: str) -> list:
+    # split a sentence of 'token__pos' strings into a list of (token, pos) tuples, in one pass
+    return RE_TAGGED_TOKEN.findall(sentence)
 
 
 class PostgresAPI:
-    def __init__(self, user="semantic_kb", password="semantic_kb", database="semantic_kb", maintenance=False) -> None:
+    # Advanced whenever content readable from semantic_kb changes, so that cached query results of earlier
+    # generations are never reused. Shared by all instances, as the maintenance instance swaps in the content
+    generations = count(1)
+    generation = 0
+
+    def __init__(self, user="semantic_kb", password="semantic_kb", database="semantic_kb", maintenance=False,
+                 pool_size: int = POOL_SIZE) -> None:
         super().__init__()
         self.maintenance = maintenance
         self.schema_name = "semantic_kb" if not self.maintenance else "maintenance"
-        psql.paramstyle = 'qmark'
-        self.conn = psql.connect(user=user, password=password, database=database)
-        self.cursor = self.conn.cursor()
-        self.cursor.execute('''SET SEARCH_PATH TO {0}'''.format(self.schema_name))
-        self.autocommit = False
+        # Pool of connections shared by all threads. Pooled connections autocommit, so that a read costs a single
+        # round trip. begin_batch() turns this off on the connection it pins, to group writes into one transaction
+        self.pool = Queue()
+        for _ in range(pool_size):
+            conn = psycopg.connect(user=user, password=password, dbname=database, host='localhost',
+                                   client_encoding='utf8', autocommit=True)
+            conn.cursor().execute('''SET SEARCH_PATH TO {0}, public'''.format(self.schema_name))
+            conn.cursor().execute('''SET pg_trgm.similarity_threshold = {0}'''.format(SIMILARITY_THRESHOLD))
+            self.pool.put(conn)
+        # Connection pinned to the current thread by begin_batch(), if any
+        self.local = local()
+        # Per-instance cache of query_sentence_ids() results
+        self.query_cache = lru_cache(maxsize=QUERY_CACHE_SIZE)(self.__cached_query_sentence_ids)
         if self.maintenance:
             self.create_schema()
-            self.conn.commit()
+
+    @contextmanager
+    def _get_conn(self, transaction: bool = False):
+        # Use the connection pinned to this thread by begin_batch(), if any
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        # Else, borrow a connection for this call only. Each statement autocommits, unless the call needs several
+        # statements to succeed or fail together (transaction=True)
+        conn = self.pool.get(timeout=POOL_TIMEOUT)
+        try:
+            if transaction:
+                with conn.transaction():
+                    yield conn
+            else:
+                yield conn
+        finally:
+            self.pool.put(conn)
 
     def initialize_db(self):
-        self.drop_schema()
-        self.create_schema()
-        self.conn.commit()
+        self.begin_bulk_load()
+        try:
+            self.drop_schema()
+            self.create_schema()
+        except Exception:
+            self.rollback_batch()
+            raise
+        self.commit_batch()
 
     def create_schema(self) -> None:
-        cursor = self.conn.cursor()
+        with self._get_conn(transaction=True) as conn:
+            self.__create_schema(conn.cursor())
+
+    def __create_schema(self, cursor) -> None:
 
         # Create Schema
         cursor.execute('''CREATE SCHEMA IF NOT EXISTS {0}'''.format(self.schema_name))
@@ -66,8 +120,9 @@ class PostgresAPI:
         # Create Table for Normalizations
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS normalizations (
-              sentence_id SERIAL,
-              entity_id SERIAL
+              sentence_id INTEGER REFERENCES sentences(sentence_id) ON DELETE CASCADE,
+              entity_id INTEGER REFERENCES entities(entity_id) ON DELETE CASCADE,
+              PRIMARY KEY(sentence_id, entity_id)
             )''')
 
         # Create Table for Frames
@@ -77,15 +132,25 @@ class PostgresAPI:
             sentence_ids INTEGER[] DEFAULT '{}'
             )''')
 
+        # Create Indexes for looking up normalizations by entity (primary key covers sentence), and sentences by heading
+        cursor.execute('''CREATE INDEX IF NOT EXISTS norm_entity_idx ON normalizations(entity_id)''')
+        cursor.execute('''CREATE INDEX IF NOT EXISTS sentences_heading_idx ON sentences(heading_id)''')
+
         # Add Fuzzy String match extensions for schema
         cursor.execute('''CREATE EXTENSION IF NOT EXISTS fuzzystrmatch SCHEMA semantic_kb''')
 
+        # Add Trigram extension (in public, so that dropping semantic_kb does not cascade to the index below)
+        cursor.execute('''CREATE EXTENSION IF NOT EXISTS pg_trgm SCHEMA public''')
+
+        # Add Trigram index on entities, for fuzzy entity lookups
+        cursor.execute('''CREATE INDEX IF NOT EXISTS entities_trgm_idx ON entities USING GIN (entity gin_trgm_ops)''')
+
         # Add ROOT Record for Headings. Every heading maps to this (To avoid foreign key violations)
         cursor.execute('''SELECT EXISTS(SELECT heading_id FROM headings WHERE heading_id = 1)''')
         if not cursor.fetchone()[0]:
             cursor.execute('''
               INSERT INTO headings (heading, parent_id) 
-              VALUES (?, NULL) 
+              VALUES (%s, NULL) 
               ON CONFLICT (heading_id) DO NOTHING ''', [ROOT_NODE_NAME])
 
         # Add Function to get heading hierarchy
@@ -142,117 +207,210 @@ class PostgresAPI:
             LANGUAGE plpgsql
         ''')
 
+        # Add Function to insert a heading hierarchy (top-down) and return the heading_id of the last heading
+        cursor.execute('''
+            CREATE OR REPLACE FUNCTION insert_headings(hierarchy TEXT[])
+              RETURNS INTEGER AS
+            $$ DECLARE
+              current_id INTEGER := 1;
+              current_heading TEXT;
+            BEGIN
+              FOREACH current_heading IN ARRAY hierarchy LOOP
+                INSERT INTO headings (heading, parent_id)
+                VALUES (current_heading, current_id)
+                ON CONFLICT(heading, parent_id) DO UPDATE SET parent_id = EXCLUDED.parent_id
+                RETURNING headings.heading_id INTO current_id;
+              END LOOP;
+              RETURN current_id;
+            END; $$
+            LANGUAGE plpgsql
+        ''')
+
         # Create View for observing content under each heading
-        self.cursor.execute('''
+        cursor.execute('''
             CREATE OR REPLACE VIEW heading_content AS
               SELECT headings.heading_id, headings.heading, array_agg(sentences.sentence ORDER BY sentence_id ASC) AS content
               FROM (headings JOIN sentences USING (heading_id))
               GROUP BY headings.heading_id
         ''')
 
-        # Commit the DDL
-        if self.autocommit:
-            self.conn.commit()
-
     def drop_schema(self) -> None:
-        cursor = self.conn.cursor()
-        cursor.execute('''DROP SCHEMA IF EXISTS {0} CASCADE'''.format(self.schema_name))
-        if self.autocommit:
-            self.conn.commit()
+        with self._get_conn() as conn:
+            conn.cursor().execute('''DROP SCHEMA IF EXISTS {0} CASCADE'''.format(self.schema_name))
 
     def truncate_tables(self) -> None:
-        self.cursor.execute('''
-            TRUNCATE 
-            normalizations, headings, entities, 
-            sentences, frames, 
-            RESTART IDENTITY''')
-        if self.autocommit:
-            self.conn.commit()
+        with self._get_conn() as conn:
+            conn.cursor().execute('''
+                TRUNCATE 
+                normalizations, headings, entities, 
+                sentences, frames, 
+                RESTART IDENTITY''')
+
+    def analyze_tables(self) -> None:
+        # Refresh the table statistics once content is populated. Besides the query planner, get_sentence_count()
+        # reads its estimate from them
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            for table in ['entities', 'headings', 'sentences', 'normalizations', 'frames']:
+                cursor.execute('ANALYZE {0}'.format(table))
+
+    def begin_batch(self) -> None:
+        # Pin a pooled connection to the current thread, so that every call until commit_batch() shares one transaction
+        # (raises queue.Empty if no connection is returned to the pool within POOL_TIMEOUT seconds)
+        if getattr(self.local, 'conn', None) is None:
+            conn = self.pool.get(timeout=POOL_TIMEOUT)
+            conn.autocommit = False
+            self.local.conn = conn
+
+    def begin_bulk_load(self) -> None:
+        # Begin a batch that commits without waiting for the WAL flush. A crash may lose the last few committed
+        # batches (the database stays consistent), so use this only for ingest that can be re-run from its source
+        self.begin_batch()
+        self.local.conn.cursor().execute('SET LOCAL synchronous_commit = off')
+
+    def commit_batch(self) -> None:
+        # Commit every call made since begin_batch(), and return the pinned connection to the pool
+        conn, self.local.conn = getattr(self.local, 'conn', None), None
+        if conn is None:
+            return
+        try:
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.autocommit = True
+            self.pool.put(conn)
+            self.__content_changed()
+
+    def __content_changed(self) -> None:
+        # Writes to the maintenance schema are not visible to readers until commit() swaps it in
+        if not self.maintenance:
+            PostgresAPI.generation = next(PostgresAPI.generations)
+
+    def rollback_batch(self) -> None:
+        # Discard every call made since begin_batch(), and return the pinned connection to the pool
+        conn, self.local.conn = getattr(self.local, 'conn', None), None
+        if conn is None:
+            return
+        try:
+            conn.rollback()
+        finally:
+            conn.autocommit = True
+            self.pool.put(conn)
 
     def insert_heading(self, heading: str, parent_id: int = None) -> int:
         # Insert one heading along with its parent_id, and return the new heading_id
-        self.cursor.execute('''
-            INSERT INTO headings (heading, parent_id) 
-            VALUES (?,?) 
-            ON CONFLICT(heading, parent_id) DO UPDATE SET parent_id = EXCLUDED.parent_id
-            RETURNING heading_id
-        ''', [heading, parent_id if parent_id else 1])
-        heading_id = self.cursor.fetchone()[0]
-        if self.autocommit:
-            self.conn.commit()
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO headings (heading, parent_id) 
+                VALUES (%s,%s) 
+                ON CONFLICT(heading, parent_id) DO UPDATE SET parent_id = EXCLUDED.parent_id
+                RETURNING heading_id
+            ''', [heading, parent_id if parent_id else 1])
+            heading_id = cursor.fetchone()[0]
         return int(heading_id)
 
     def insert_headings(self, headings: list) -> int:
-        current_parent = None
-        for heading in headings:
-            current_parent = self.insert_heading(heading, current_parent)
-        if self.autocommit:
-            self.conn.commit()
-        return int(current_parent)
+        # Insert the whole heading hierarchy server-side, and return the heading_id of the last heading
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''SELECT insert_headings(%s::TEXT[])''', [list(headings)])
+            heading_id = cursor.fetchone()[0]
+        return int(heading_id)
 
     def insert_sentence(self, sentence: str, entities: set, dependencies: set, heading_id: int = None) -> int:
-        # Insert parametrized sentence
-        self.cursor.execute('''
-            INSERT INTO sentences (sentence, dependencies, heading_id) VALUES (?,?,?) 
-            ON CONFLICT (sentence, heading_id) DO UPDATE SET sentence = EXCLUDED.sentence 
-            RETURNING sentence_id''', [sentence, str_conv(list(dependencies)), heading_id])
-        sentence_id = self.cursor.fetchone()[0]
-
-        # Insert normalized entities into database, along with the normalization
-        for entity in entities:
-            self.cursor.execute('''
-                INSERT INTO entities (entity) VALUES (?) 
-                ON CONFLICT (entity) DO UPDATE SET entity = EXCLUDED.entity
-                RETURNING entity_id
-            ''', [entity])
-            entity_id = self.cursor.fetchall()[0][0]
-            # Insert normalization record to map normalization -> original string
-            self.cursor.execute('''
-                INSERT INTO normalizations(sentence_id, entity_id) VALUES (?,?)
-            ''', [sentence_id, entity_id])
-        if self.autocommit:
-            self.conn.commit()
-        print('.', end='', flush=True)
+        with self._get_conn(transaction=True) as conn:
+            cursor = conn.cursor()
+            # Insert parametrized sentence
+            cursor.execute('''
+                INSERT INTO sentences (sentence, dependencies, heading_id) VALUES (%s,%s,%s) 
+                ON CONFLICT (sentence, heading_id) DO UPDATE SET sentence = EXCLUDED.sentence 
+                RETURNING sentence_id''', [sentence, list(dependencies), heading_id])
+            sentence_id = cursor.fetchone()[0]
+
+            # Insert normalized entities into database in one statement, along with the normalizations.
+            # Array parameters keep the statement text constant, so psycopg prepares it once per connection
+            if len(entities) > 0:
+                cursor.execute('''
+                    INSERT INTO entities (entity) SELECT unnest(%s::TEXT[])
+                    ON CONFLICT (entity) DO UPDATE SET entity = EXCLUDED.entity
+                    RETURNING entity_id
+                ''', [list(entities)])
+                entity_ids = [row[0] for row in cursor.fetchall()]
+                # Insert normalization records to map normalization -> original string
+                cursor.execute('''
+                    INSERT INTO normalizations(sentence_id, entity_id) SELECT %s, unnest(%s::INTEGER[])
+                    ON CONFLICT DO NOTHING
+                ''', [sentence_id, entity_ids])
+        self.__content_changed()
         return int(sentence_id)
 
     def insert_frames(self, sentence_id: str, frames: set) -> None:
-        for frame in frames:
-            self.cursor.execute('''
-                INSERT INTO frames (frame, sentence_ids) VALUES (?,?) 
+        if len(frames) == 0:
+            return
+        with self._get_conn() as conn:
+            conn.cursor().execute('''
+                INSERT INTO frames (frame, sentence_ids) SELECT unnest(%s::TEXT[]), %s::INTEGER[]
                 ON CONFLICT (frame) DO UPDATE SET sentence_ids = frames.sentence_ids || EXCLUDED.sentence_ids
-            ''', [frame, str_conv([sentence_id])])
-        if self.autocommit:
-            self.conn.commit()
+            ''', [list(frames), [sentence_id]])
+        self.__content_changed()
 
     def get_heading_hierarchy(self, heading_id: int) -> list:
-        self.cursor.execute('''
-            SELECT heading_id, heading, index FROM get_hierarchy(?)
-            ''', [heading_id])
-        return self.cursor.fetchall()
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT heading_id, heading, index FROM get_hierarchy(%s)
+                ''', [heading_id])
+            return cursor.fetchall()
 
     def get_sentences_by_id(self, sentence_ids: list) -> next:
-        for sentence_id in sentence_ids:
-            self.cursor.execute('''
+        sentence_ids = list(sentence_ids)
+        if len(sentence_ids) == 0:
+            return
+        # get all sentences in one query, preserving the order of sentence_ids
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
               SELECT sentence_id, sentence FROM sentences 
-              WHERE sentence_id = ?
-            ''', [sentence_id])
-            # get the sentence text and return the output as a list
-            row = self.cursor.fetchone()
-            if row is not None:
-                yield (row[0], (tuple(str.rsplit(tag, SPLIT_CHAR, 1)) for tag in row[1].split()))
+              WHERE sentence_id = ANY(%s::INTEGER[])
+              ORDER BY array_position(%s::INTEGER[], sentence_id)
+            ''', [sentence_ids, sentence_ids])
+            rows = cursor.fetchall()
+        for row in rows:
+            yield (row[0], split_tags(row[1]))
 
     def get_all_sentences(self) -> next:
-        self.cursor.execute('SELECT sentence_id, sentence FROM sentences')
-        for row in self.cursor.fetchall():
-            yield (row[0], (tuple(str.rsplit(tag, SPLIT_CHAR, 1)) for tag in row[1].split()))
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT sentence_id, sentence FROM sentences')
+            rows = cursor.fetchall()
+        for row in rows:
+            yield (row[0], split_tags(row[1]))
 
     def get_sentence_count(self) -> int:
-        self.cursor.execute('SELECT count(sentence_id) FROM sentences')
-        return self.cursor.fetchone()[0]
+        """
+        Returns the number of sentences in KB, as estimated by the last ANALYZE (see analyze_tables). The estimate
+        may be off until the table is analyzed again, so only use it where an approximate count is acceptable
+
+        :return: estimated sentence count
+        """
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            # Read the row estimate instead of counting rows on each read (or maintaining a counter on each write).
+            # Until the table is analyzed, reltuples is 0 or -1, so fall back to counting
+            cursor.execute('''
+                SELECT CASE WHEN reltuples > 0 THEN reltuples::BIGINT ELSE (SELECT count(*) FROM sentences) END
+                FROM pg_class WHERE oid = 'sentences'::REGCLASS
+            ''')
+            return int(cursor.fetchone()[0])
 
     def get_all_entities(self) -> tuple:
-        self.cursor.execute('SELECT entity_id, entity FROM entities ORDER BY entity')
-        return self.cursor.fetchall()
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT entity_id, entity FROM entities ORDER BY entity')
+            return cursor.fetchall()
 
     def query_sentence_ids(self, entities: dict, frames: set) -> dict:
         """
@@ -263,41 +421,64 @@ class PostgresAPI:
         :param frames: Set of question frames
         :return: sets of potential sentence ids that could be the answer
         """
+        # Answer repeated questions from the cache. Ngram lists are frozen into tuples so that arguments are hashable
+        result = self.query_cache(
+            frozenset((entity, tuple(tuple(ngrams) for ngrams in entities[entity])) for entity in entities),
+            frozenset(frames),
+            PostgresAPI.generation
+        )
+        # Copy the cached result, so that callers cannot modify it
+        return {heading: list(sentence_ids) for heading, sentence_ids in result.items()}
+
+    def __cached_query_sentence_ids(self, entities: frozenset, frames: frozenset, generation: int) -> dict:
+        # generation is only part of the cache key
+        entities = {entity: [list(ngrams) for ngrams in ngram_lists] for entity, ngram_lists in entities}
+        return self.__query_sentence_ids(entities, set(frames))
+
+    def __query_sentence_ids(self, entities: dict, frames: set) -> dict:
         n = max(len(x.split()) for x in entities)
 
         # Get the entity ids matching the input entities as a dict of entity --> its direct/fuzzy matches
         def get_matching_entity_ids(input_entities: dict, ngram_level: int) -> dict:
-            entity_ids = {}
-            q_string = '''
-            SELECT 
-              entity_id, 
-              length(entity) entity_length,
-              semantic_kb.levenshtein(entity, '{0}', 2, 1, 2) edit_distance
-            FROM 
-              entities
-            WHERE
-              (length(entity) BETWEEN length('{0}') AND {1})
-            AND (
-              entity LIKE '{0}%%' 
-              OR entity LIKE '%%{0}' 
-              OR semantic_kb.levenshtein(entity, '{0}', 2, 1, 2) < {2}
-            ) 
-            ORDER BY entity_length ASC, edit_distance ASC LIMIT 3
-            '''
+            entity_ids = {entity: [] for entity in input_entities}
+            # search terms as (entity, term) pairs: the entity itself, followed by its ngrams (if needed)
+            search_terms = []
             for entity in input_entities:
-                entity_ids[entity] = []
-                # execute direct string match
-                self.cursor.execute(q_string.format(entity, MAX_ENTITY_LENGTH, ERROR_TOLERANCE))
-                # get set of rows and append to matching_entity_ids set
-                entity_ids[entity] += [int(row[0]) for row in self.cursor.fetchall()]
+                search_terms += [(entity, entity)]
                 # go through all ngrams until some entity match occurs, then break
                 if len(input_entities[entity]) < ngram_level:
                     continue
                 for ngrams in input_entities[entity][0: len(input_entities[entity]) - ngram_level + 1]:
-                    for ngram in ngrams:
-                        self.cursor.execute(q_string.format(ngram, MAX_ENTITY_LENGTH, ERROR_TOLERANCE))
-                        entity_ids[entity] += [int(row[0]) for row in self.cursor.fetchall()]
-            return entity_ids
+                    search_terms += [(entity, ngram) for ngram in ngrams]
+            # get the top 3 matches of every search term in one query. The trigram index narrows down the
+            # candidates (similarity >= SIMILARITY_THRESHOLD), so that levenshtein distance is only calculated for them
+            with self._get_conn() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                SELECT Q.term_index, M.entity_id FROM
+                  unnest(%s::TEXT[]) WITH ORDINALITY AS Q(term, term_index)
+                CROSS JOIN LATERAL (
+                  SELECT 
+                    entity_id, 
+                    length(entity) entity_length,
+                    semantic_kb.levenshtein(entity, Q.term, 2, 1, 2) edit_distance
+                  FROM 
+                    entities
+                  WHERE
+                    (length(entity) BETWEEN length(Q.term) AND %s)
+                  AND (
+                    entity LIKE Q.term || '%%' 
+                    OR entity LIKE '%%' || Q.term 
+                    OR (entity %% Q.term AND semantic_kb.levenshtein(entity, Q.term, 2, 1, 2) < %s)
+                  ) 
+                  ORDER BY entity_length ASC, edit_distance ASC LIMIT 3
+                ) AS M
+                ORDER BY Q.term_index ASC, M.entity_length ASC, M.edit_distance ASC
+                ''', [[term for entity, term in search_terms], MAX_ENTITY_LENGTH, ERROR_TOLERANCE])
+                # append the matches of each search term to its entity (term_index is 1-based)
+                for term_index, entity_id in cursor.fetchall():
+                    entity_ids[search_terms[term_index - 1][0]] += [int(entity_id)]
+                return entity_ids
 
         # Get the sentence ids of the sentences containing the passed entity ids
         def get_entity_matching_sent_ids(input_entities: dict) -> dict:
@@ -318,10 +499,9 @@ class PostgresAPI:
                     'bool_or(E{0})'.format(x) for x in range(len(non_empty_entities))
                 )
             )
-            # Entity parameter returns what elements triggered the sentence
+            # Entity parameter returns what elements triggered the sentence (entity ids are bound as arrays)
             entity_param = ', '.join(
-                '(array_agg(entity_id) && ARRAY[{0}]) AS E{1}'.format(str(input_entities[entity])[1:-1], i)
-                for i, entity in enumerate(non_empty_entities)
+                '(array_agg(entity_id) && %s::INTEGER[]) AS E{0}'.format(i) for i in range(len(non_empty_entities))
             )
             # Condition parameter filters results and return only matching results
             condition_param = ' OR '.join(
@@ -333,41 +513,37 @@ class PostgresAPI:
             # ---------------------
             # ------------------------------------------
             # Execute the query using the params
-            self.cursor.execute(
-                '''
-                SELECT heading_id, sentence_ids FROM (
-                    SELECT heading_id, array_agg(sentence_id) sentence_ids, {0} FROM
-                    (SELECT DISTINCT sentence_id, {1} FROM normalizations GROUP BY sentence_id) AS TEMP
-                    NATURAL JOIN sentences
-                    NATURAL JOIN headings
-                    WHERE {2}
-                    GROUP BY heading_id
-                ) AS TBL
-                WHERE {3}
-                '''.format(column_param, entity_param, condition_param, filter_param)
-            )
-            # Return the matching sentence_ids grouped under each heading_id
-            return {heading: sentence_ids for heading, sentence_ids in self.cursor.fetchall()}
+            with self._get_conn() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    '''
+                    SELECT heading_id, sentence_ids FROM (
+                        SELECT heading_id, array_agg(sentence_id) sentence_ids, {0} FROM
+                        (SELECT DISTINCT sentence_id, {1} FROM normalizations GROUP BY sentence_id) AS TEMP
+                        NATURAL JOIN sentences
+                        NATURAL JOIN headings
+                        WHERE {2}
+                        GROUP BY heading_id
+                    ) AS TBL
+                    WHERE {3}
+                    '''.format(column_param, entity_param, condition_param, filter_param),
+                    [input_entities[entity] for entity in non_empty_entities]
+                )
+                # Return the matching sentence_ids grouped under each heading_id
+                return {heading: sentence_ids for heading, sentence_ids in cursor.fetchall()}
 
         # Return if any element in sent_ids match any frame in input_frames
         def check_frame_match(sent_ids: set, input_frames: set) -> bool:
             if len(sent_ids) == 0 or len(input_frames) == 0:
                 return False
             else:
-                frame_param = str(input_frames)[1:-1]
-                sent_param = str(sent_ids)[1:-1]
-                # self.cursor.execute('''
-                #     SELECT count(DISTINCT F.frame) FROM
-                #       (SELECT DISTINCT frame, unnest(sentence_ids) AS sentence_id FROM frames) AS F
-                #     WHERE
-                #       F.frame IN ({0}) AND
-                #       F.sentence_id IN ({1})
-                # '''.format(frame_param, sent_param))
-                self.cursor.execute('''
-                    SELECT bool_or(sentence_ids && ARRAY[{0}]) AS has_match FROM frames WHERE frame IN ({1})
-                    '''.format(sent_param, frame_param))
-                result = self.cursor.fetchone()[0]
-                return result
+                with self._get_conn() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute('''
+                        SELECT bool_or(sentence_ids && %s::INTEGER[]) AS has_match FROM frames WHERE frame = ANY(%s::TEXT[])
+                        ''', [list(sent_ids), list(input_frames)])
+                    result = cursor.fetchone()[0]
+                    return result
 
         # Get entity matching sentences, grouped under headings
         entity_ids_dict = {}
@@ -402,40 +578,59 @@ class PostgresAPI:
     def get_heading_info_by_ids(self, heading_ids: list) -> dict:
         if heading_ids is None or len(heading_ids) == 0:
             return {}
-        h_id_param = str(sorted(heading_ids))[1:-1]
-        self.cursor.execute('''
-          SELECT
-            H.heading_id,
-            H.heading,
-            MIN(sentence_id) first_sentence_id,
-            MAX(sentence_id) last_sentence_id
-          FROM headings as H
-          NATURAL JOIN sentences as S
-          WHERE heading_id IN ({0})
-          GROUP BY heading_id
-        '''.format(h_id_param))
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            # aggregate the sentence bounds per heading first, so that headings are joined once per heading
+            cursor.execute('''
+              WITH bounds AS (
+                SELECT heading_id, MIN(sentence_id) lo, MAX(sentence_id) hi
+                FROM sentences
+                WHERE heading_id = ANY(%s::INTEGER[])
+                GROUP BY heading_id
+              )
+              SELECT
+                B.heading_id,
+                H.heading,
+                B.lo first_sentence_id,
+                B.hi last_sentence_id
+              FROM bounds as B
+              JOIN headings as H USING (heading_id)
+            ''', [list(heading_ids)])
+            rows = cursor.fetchall()
         print('Heading info returned...')
-        return {heading_id: (heading, min_id, max_id) for heading_id, heading, min_id, max_id in self.cursor.fetchall()}
+        return {heading_id: (heading, min_id, max_id) for heading_id, heading, min_id, max_id in rows}
 
     def get_heading_content_by_id(self, heading_id: int) -> dict:
-        self.cursor.execute('''
-          SELECT heading_id, heading, content FROM heading_content
-          WHERE heading_id = ?
-        ''', [heading_id])
-        row = self.cursor.fetchone()
+        with self._get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+              SELECT heading_id, heading, content FROM heading_content
+              WHERE heading_id = %s
+            ''', [heading_id])
+            row = cursor.fetchone()
         if row is None:
             return {}
         else:
             return {
                 'heading_id': row[0],
                 'heading': row[1],
-                'content': ((tuple(str.rsplit(tag, SPLIT_CHAR, 1)) for tag in sent.split()) for sent in row[2])
+                'content': [split_tags(sent) for sent in row[2]]
             }
 
     def commit(self):
-        if self.maintenance:
-            self.cursor.execute('DROP SCHEMA IF EXISTS semantic_kb CASCADE')
-            self.cursor.execute('ALTER SCHEMA maintenance RENAME TO semantic_kb')
-            self.cursor.execute('''CREATE EXTENSION IF NOT EXISTS fuzzystrmatch SCHEMA semantic_kb''')
-            self.create_schema()
-        self.conn.commit()
+        # Commit any open batch. In maintenance mode, also replace the production schema with the maintenance schema
+        self.begin_batch()
+        try:
+            if self.maintenance:
+                with self._get_conn() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute('DROP SCHEMA IF EXISTS semantic_kb CASCADE')
+                    cursor.execute('ALTER SCHEMA maintenance RENAME TO semantic_kb')
+                    cursor.execute('''CREATE EXTENSION IF NOT EXISTS fuzzystrmatch SCHEMA semantic_kb''')
+                self.create_schema()
+        except Exception:
+            self.rollback_batch()
+            raise
+        self.commit_batch()
+        # The swapped-in content is now visible to readers
+        PostgresAPI.generation = next(PostgresAPI.generations)